@@ -127,10 +127,12 @@ def apply_opacity(im, opacity):
         im.putalpha(opacity)
         return im
     elif im.mode == 'RGBA':
-        r, g, b, a = im.split()
+        if opacity == 255:
+            return im
+        # scale alpha in a single pass; color bands are mapped to themselves
         opacity_scale = opacity / 255
-        a = a.point(lambda i: i*opacity_scale)
-        return Image.merge('RGBA', [r, g, b, a])
+        lut = list(range(256)) * 3 + [i*opacity_scale for i in range(256)]
+        return im.point(lut)
     else:
         raise NotImplementedError()
 
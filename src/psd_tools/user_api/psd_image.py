@@ -3,11 +3,15 @@ from __future__ import absolute_import, unicode_literals, division
 
 import logging
 import collections
+import errno
+import mmap
+import os
 import weakref              # FIXME: there should be weakrefs in this module
 import psd_tools.reader
 import psd_tools.decoder
 from psd_tools.constants import (TaggedBlock, SectionDivider, BlendMode,
     TextProperty, PlacedLayerProperty, SzProperty, ChannelID)
+from psd_tools.decoder.linked_layer import LinkedLayerCollection
 from psd_tools.user_api.layers import group_layers
 from psd_tools.user_api import pymaging_support
 from psd_tools.user_api import pil_support
@@ -15,11 +19,15 @@ from psd_tools.user_api.embedded import Embedded
 
 logger = logging.getLogger(__name__)
 
+_UNSET = object()
+
 
 Size = collections.namedtuple('Size', 'width, height')
 
 
 class BBox(collections.namedtuple('BBox', 'x1, y1, x2, y2')):
+    __slots__ = ()
+
     @property
     def width(self):
         return self.x2-self.x1
@@ -30,12 +38,16 @@ class BBox(collections.namedtuple('BBox', 'x1, y1, x2, y2')):
 
 
 class TextData(object):
+    __slots__ = ('text',)
+
     def __init__(self, tagged_blocks):
         text_data = dict(tagged_blocks.text_data.items)
         self.text = text_data[TextProperty.TXT].value
 
 
 class PlacedLayerData(object):
+    __slots__ = ('transform', 'size')
+
     def __init__(self, placed_layer_block):
         placed_layer_data = dict(placed_layer_block)
         self.transform = placed_layer_data[PlacedLayerProperty.TRANSFORM].items
@@ -43,6 +55,8 @@ class PlacedLayerData(object):
 
 
 class MaskData(object):
+    __slots__ = ('mask_data', '_decoded_data', '_layer_index')
+
     def __init__(self, layer):
         self.mask_data = layer._info.mask_data
         self._decoded_data = layer._psd.decoded_data
@@ -64,8 +78,10 @@ class MaskData(object):
 
     @property
     def is_valid(self):
-        bbox = self.bbox
-        return bbox.width > 0 and bbox.height > 0
+        md = self.mask_data
+        if md.real_flags:
+            return md.real_right > md.real_left and md.real_bottom > md.real_top
+        return md.right > md.left and md.bottom > md.top
 
     def as_PIL(self, real_mask=True):
         """
@@ -89,6 +105,8 @@ class MaskData(object):
 
 
 class PatternData(object):
+    __slots__ = ('_pattern',)
+
     def __init__(self, pattern):
         self._pattern = pattern
 
@@ -122,9 +140,15 @@ class _RawLayer(object):
     they share some common properties.
     """
 
-    parent = None
-    _psd = None
-    _index = None
+    __slots__ = ('parent', '_psd', '_index', '_info_cache',
+                 '_visible_global_cache', '__weakref__')
+
+    def __init__(self, parent, index):
+        self.parent = parent
+        self._psd = parent._psd
+        self._index = index
+        self._info_cache = _UNSET
+        self._visible_global_cache = _UNSET
 
     @property
     def name(self):
@@ -142,7 +166,10 @@ class _RawLayer(object):
     @property
     def visible_global(self):
         """ Layer visibility. Takes group visibility in account. """
-        return self.visible and self.parent.visible
+        if self._visible_global_cache is _UNSET:
+            self._visible_global_cache = (self.visible and
+                                          self.parent.visible_global)
+        return self._visible_global_cache
 
     @property
     def layer_id(self):
@@ -158,20 +185,26 @@ class _RawLayer(object):
 
     @property
     def _info(self):
-        return self._psd._layer_info(self._index)
+        # layer records are never modified after parsing
+        if self._info_cache is _UNSET:
+            self._info_cache = self._psd._layer_info(self._index)
+        return self._info_cache
 
     @property
     def _tagged_blocks(self):
-        return dict(self._info.tagged_blocks)
+        return self._psd._layer_tagged_blocks(self._index)
 
 
 class Layer(_RawLayer):
     """ PSD layer wrapper """
 
+    __slots__ = ('_bbox_cache', '_placed_cache', '_text_data_cache')
+
     def __init__(self, parent, index):
-        self.parent = parent
-        self._psd = parent._psd
-        self._index = index
+        super(Layer, self).__init__(parent, index)
+        self._bbox_cache = _UNSET
+        self._placed_cache = _UNSET
+        self._text_data_cache = _UNSET
 
     def as_PIL(self):
         """ Returns a PIL image for this layer. """
@@ -184,6 +217,11 @@ class Layer(_RawLayer):
     @property
     def bbox(self):
         """ BBox(x1, y1, x2, y2) namedtuple with layer bounding box. """
+        if self._bbox_cache is _UNSET:
+            self._bbox_cache = self._get_bbox()
+        return self._bbox_cache
+
+    def _get_bbox(self):
         info = self._info
         return BBox(info.left, info.top, info.right, info.bottom)
 
@@ -193,10 +231,9 @@ class Layer(_RawLayer):
         (Top Left and Bottom Right corners). The tranform of a layer the
         points for all 4 corners.
         """
-        placed_layer_block = self._placed_layer_block()
-        if not placed_layer_block:
+        placed_layer_data = self._placed_layer_data
+        if placed_layer_data is None:
             return None
-        placed_layer_data = PlacedLayerData(placed_layer_block)
 
         transform = placed_layer_data.transform
         if not transform:
@@ -208,25 +245,34 @@ class Layer(_RawLayer):
         """ BBox(x1, y1, x2, y2) namedtuple with original
         smart object content size.
         """
-        placed_layer_block = self._placed_layer_block()
-        if not placed_layer_block:
+        placed_layer_data = self._placed_layer_data
+        if placed_layer_data is None:
             return None
-        placed_layer_data = PlacedLayerData(placed_layer_block)
 
         size = placed_layer_data.size
         if not size:
             return None
         return Size(size[SzProperty.WIDTH].value, size[SzProperty.HEIGHT].value)
 
+    @property
+    def _placed_layer_data(self):
+        if self._placed_cache is _UNSET:
+            placed_layer_block = self._placed_layer_block()
+            self._placed_cache = (PlacedLayerData(placed_layer_block)
+                                  if placed_layer_block else None)
+        return self._placed_cache
+
     def _placed_layer_block(self):
-        so_layer_block = self._tagged_blocks.get(TaggedBlock.SMART_OBJECT_PLACED_LAYER_DATA)
-        return self._tagged_blocks.get(TaggedBlock.PLACED_LAYER_DATA, so_layer_block)
+        blocks = self._tagged_blocks
+        so_layer_block = blocks.get(TaggedBlock.SMART_OBJECT_PLACED_LAYER_DATA)
+        return blocks.get(TaggedBlock.PLACED_LAYER_DATA, so_layer_block)
 
     @property
     def text_data(self):
-        tagged_blocks = self._tagged_blocks.get(TaggedBlock.TYPE_TOOL_OBJECT_SETTING)
-        if tagged_blocks:
-            return TextData(tagged_blocks)
+        if self._text_data_cache is _UNSET:
+            tagged_blocks = self._tagged_blocks.get(TaggedBlock.TYPE_TOOL_OBJECT_SETTING)
+            self._text_data_cache = TextData(tagged_blocks) if tagged_blocks else None
+        return self._text_data_cache
 
     @property
     def mask_data(self):
@@ -242,6 +288,12 @@ class Layer(_RawLayer):
 class ShapeLayer(Layer):
     """ PSD shape layer wrapper """
 
+    __slots__ = ('_anchors_cache',)
+
+    def __init__(self, parent, index):
+        super(ShapeLayer, self).__init__(parent, index)
+        self._anchors_cache = _UNSET
+
     def as_PIL(self):
         """ Returns a PIL image for this layer. """
         return pil_support.draw_polygon(self.bbox, self.anchors,
@@ -251,28 +303,30 @@ class ShapeLayer(Layer):
         """ Returns a pymaging.Image for this PSD file. """
         raise NotImplementedError
 
-    @property
-    def bbox(self):
-        """ BBox(x1, y1, x2, y2) namedtuple of the shape. """
+    def _get_bbox(self):
+        # bounding box of the shape anchors
         anchors = self.anchors
         if not anchors or len(anchors) < 2:
             logger.warning("Empty shape anchors")
             return BBox(0, 0, 0, 0)
-        return BBox(min([p[0] for p in anchors]),
-                    min([p[1] for p in anchors]),
-                    max([p[0] for p in anchors]),
-                    max([p[1] for p in anchors]))
+        xs, ys = zip(*anchors)
+        return BBox(min(xs), min(ys), max(xs), max(ys))
 
     @property
     def anchors(self):
         """ Anchor points of the shape [(x, y), (x, y), ...]. """
+        if self._anchors_cache is _UNSET:
+            self._anchors_cache = self._get_anchors()
+        return self._anchors_cache
+
+    def _get_anchors(self):
         blocks = self._tagged_blocks
         vmsk = blocks.get(TaggedBlock.VECTOR_MASK_SETTING1,
                           blocks.get(TaggedBlock.VECTOR_MASK_SETTING2))
         if not vmsk:
             return None
-        return [(int(p['anchor'][1] * self._psd.header.width),
-                 int(p['anchor'][0] * self._psd.header.height))
+        width, height = self._psd.header.width, self._psd.header.height
+        return [(int(p['anchor'][1] * width), int(p['anchor'][0] * height))
                 for p in vmsk.path if p.get('selector') in (1, 2)]
 
     def _get_color(self, default='black'):
@@ -297,11 +351,12 @@ class ShapeLayer(Layer):
 class Group(_RawLayer):
     """ PSD layer group wrapper """
 
+    __slots__ = ('layers', '_bbox_cache')
+
     def __init__(self, parent, index, layers):
-        self.parent = parent
-        self._psd = parent._psd
-        self._index = index
+        super(Group, self).__init__(parent, index)
         self.layers = layers
+        self._bbox_cache = _UNSET
 
     @property
     def closed(self):
@@ -316,7 +371,9 @@ class Group(_RawLayer):
         BBox(x1, y1, x2, y2) namedtuple with a bounding box for
         all layers in this group; None if a group has no children.
         """
-        return combined_bbox(self.layers)
+        if self._bbox_cache is _UNSET:
+            self._bbox_cache = combined_bbox(self.layers)
+        return self._bbox_cache
 
     @property
     def mask_data(self):
@@ -331,46 +388,89 @@ class Group(_RawLayer):
 
     def _add_layer(self, child):
         self.layers.append(child)
+        # the new child may change the bbox of this group and its ancestors;
+        # a group's bbox is only computed along with those of its children,
+        # so ancestors of an unset group are unset as well
+        group = self
+        while isinstance(group, Group) and group._bbox_cache is not _UNSET:
+            group._bbox_cache = _UNSET
+            group = group.parent
 
     def __repr__(self):
         return "<psd_tools.Group: %r, layer_count=%d>" % (
             self.name, len(self.layers))
 
 
+_LAYER_TYPE_TO_CLS = {
+    'pixel': Layer,
+    'type': Layer,
+    'adjustment': Layer,
+    'shape': ShapeLayer,
+}
+
+
+class _MappedFile(object):
+    """
+    Read-only file-like wrapper around a ``mmap``. Unlike ``mmap.seek``,
+    seeking past the end is allowed, as it is for regular files;
+    reads from there return no data.
+    """
+
+    __slots__ = ('_mm', '_pos')
+
+    def __init__(self, mm):
+        self._mm = mm
+        self._pos = 0
+
+    def read(self, size=-1):
+        start = self._pos
+        if size is None or size < 0:
+            end = len(self._mm)
+        else:
+            end = start + size
+        data = self._mm[start:end]
+        self._pos = start + len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._mm)
+        if offset < 0:
+            raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+
 class PSDImage(object):
     """ PSD image wrapper """
 
     def __init__(self, decoded_data):
         self.header = decoded_data.header
         self.decoded_data = decoded_data
-
-        # wrap decoded data to Layer and Group structures
-        def fill_group(group, data):
-
-            for layer in data['layers']:
-                index = layer['index']
-
-                if 'layers' in layer:
-                    # group
-                    sub_group = Group(group, index, [])
-                    fill_group(sub_group, layer)
-                    group._add_layer(sub_group)
-                else:
-                    layer_type = layer['type']
-                    if layer_type == 'shape':
-                        group._add_layer(ShapeLayer(group, index))
-                    else:
-                        # regular layer
-                        group._add_layer(Layer(group, index))
+        self._layer_blocks = {}
+        self._patterns = _UNSET
 
         self._psd = self
-        fake_root_data = {'layers': group_layers(decoded_data), 'index': None}
         root = _RootGroup(self, None, [])
-        fill_group(root, fake_root_data)
+        _build_tree(root, group_layers(decoded_data))
 
         self._fake_root_group = root
         self.layers = root.layers
-        self.embedded = [Embedded(linked) for linked in self._linked_layer_iter()]
+
+        # index global tagged blocks and collect linked layers
+        # (smart objects / embedded files) in a single pass
+        self._tagged_blocks = {}
+        self.embedded = []
+        for block in decoded_data.layer_and_mask_data.tagged_blocks:
+            self._tagged_blocks[block.key] = block.data
+            if isinstance(block.data, LinkedLayerCollection):
+                self.embedded.extend(
+                    Embedded(linked) for linked in block.data.linked_list)
 
     @classmethod
     def load(cls, path, encoding='utf8'):
@@ -378,7 +478,15 @@ class PSDImage(object):
         Returns a new :class:`PSDImage` loaded from ``path``.
         """
         with open(path, 'rb') as fp:
-            return cls.from_stream(fp, encoding)
+            try:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError):
+                # empty files and files which can't be mapped on this system
+                return cls.from_stream(fp, encoding)
+            try:
+                return cls.from_stream(_MappedFile(mm), encoding)
+            finally:
+                mm.close()
 
     @classmethod
     def from_stream(cls, fp, encoding='utf8'):
@@ -420,43 +528,48 @@ class PSDImage(object):
         This may differ from the image dimensions
         (img.header.width and img.header.heigth).
         """
-        return combined_bbox(self.layers)
+        return self._fake_root_group.bbox
 
     @property
     def patterns(self):
         """
         Returns a dict of pattern (texture) data in PIL.Image.
         """
-        layer_and_mask_data = self.decoded_data.layer_and_mask_data
-        blocks = dict(layer_and_mask_data.tagged_blocks)
-        patterns = blocks.get(b'Patt', blocks.get(b'Pat2', blocks.get(
-            b'Pat3', [])))
-        return {p.pattern_id: PatternData(p) for p in patterns}
+        if self._patterns is _UNSET:
+            blocks = self._tagged_blocks
+            patterns = blocks.get(b'Patt', blocks.get(b'Pat2', blocks.get(
+                b'Pat3', [])))
+            self._patterns = {p.pattern_id: PatternData(p) for p in patterns}
+        return self._patterns
 
     def _layer_info(self, index):
         layers = self.decoded_data.layer_and_mask_data.layers.layer_records
         return layers[index]
 
+    def _layer_tagged_blocks(self, index):
+        """
+        Returns a dict of tagged blocks for a layer record. The dict is
+        built once per record and shared by all wrappers of that layer;
+        callers must not modify it.
+        """
+        blocks = self._layer_blocks.get(index)
+        if blocks is None:
+            blocks = dict(self._layer_info(index).tagged_blocks)
+            self._layer_blocks[index] = blocks
+        return blocks
+
     def _layer_as_PIL(self, index):
         return pil_support.extract_layer_image(self.decoded_data, index)
 
     def _layer_as_pymaging(self, index):
         return pymaging_support.extract_layer_image(self.decoded_data, index)
 
-    def _linked_layer_iter(self):
-        """
-        Iterate over linked layers (smart objects / embedded files)
-        """
-        from psd_tools.decoder.linked_layer import LinkedLayerCollection
-        for block in self.decoded_data.layer_and_mask_data.tagged_blocks:
-            if isinstance(block.data, LinkedLayerCollection):
-                for layer in block.data.linked_list:
-                    yield layer
-
 
 class _RootGroup(Group):
     """ A fake group for holding all layers """
 
+    __slots__ = ()
+
     @property
     def visible(self):
         return True
@@ -470,17 +583,58 @@ class _RootGroup(Group):
         return "_RootGroup"
 
 
+def _build_tree(root, layers):
+    """
+    Wraps nested layer dicts from ``group_layers`` into Layer and Group
+    structures and adds them to ``root``.
+    """
+    queue = collections.deque([(root, layers)])
+    while queue:
+        group, children = queue.popleft()
+        for layer in children:
+            index = layer['index']
+
+            if 'layers' in layer:
+                sub_group = Group(group, index, [])
+                group._add_layer(sub_group)
+                queue.append((sub_group, layer['layers']))
+            else:
+                # unknown layer types are wrapped as regular layers
+                layer_cls = _LAYER_TYPE_TO_CLS.get(layer['type'], Layer)
+                group._add_layer(layer_cls(group, index))
+
+
+def _has_area(bbox):
+    return bbox is not None and bbox.x2 > bbox.x1 and bbox.y2 > bbox.y1
+
+
 def combined_bbox(layers):
     """
     Returns a bounding box for ``layers`` or None if this is not possible.
     """
-    bboxes = [layer.bbox for layer in layers
-              if layer.bbox is not None and layer.bbox.width > 0 and layer.bbox.height > 0]
-    if not bboxes:
+    found = False
+    left = top = right = bottom = 0
+    for layer in layers:
+        bbox = layer.bbox
+        if not _has_area(bbox):
+            continue
+        x1, y1, x2, y2 = bbox
+        if not found:
+            left, top, right, bottom = x1, y1, x2, y2
+            found = True
+            continue
+        if x1 < left:
+            left = x1
+        if y1 < top:
+            top = y1
+        if x2 > right:
+            right = x2
+        if y2 > bottom:
+            bottom = y2
+
+    if not found:
         return None
-
-    lefts, tops, rights, bottoms = zip(*bboxes)
-    return BBox(min(lefts), min(tops), max(rights), max(bottoms))
+    return BBox(left, top, right, bottom)
 
 
 def merge_layers(layers, respect_visibility=True, skip_layer=lambda layer: False, bbox=None):
@@ -492,6 +646,7 @@ def merge_layers(layers, respect_visibility=True, skip_layer=lambda layer: False
 
     In order to skip some layers pass ``skip_layer`` function which
     should take ``layer` as an argument and return True or False.
+    It is called for all candidate layers before any of them is rendered.
 
     If ``bbox`` is not None, it should be a 4-tuple with coordinates;
     returned image will be restricted to this rectangle.
@@ -514,19 +669,15 @@ def merge_layers(layers, respect_visibility=True, skip_layer=lambda layer: False
         color=(255, 255, 255, 0)  # fixme: transparency calculation is incorrect
     )
 
-    for layer in reversed(layers):
+    # filter out layers which won't be rendered before doing any work
+    layers = [
+        layer for layer in reversed(layers)
+        if layer is not None and _has_area(layer.bbox) and
+        not skip_layer(layer) and
+        (layer.visible or not respect_visibility)
+    ]
 
-        if layer is None:
-            continue
-
-        if layer.bbox.width == 0 and layer.bbox.height == 0:
-            continue
-
-        if skip_layer(layer):
-            continue
-
-        if not layer.visible and respect_visibility:
-            continue
+    for layer in layers:
 
         if isinstance(layer, psd_tools.Group):
             layer_image = merge_layers(layer.layers, respect_visibility, skip_layer)
@@ -538,23 +689,26 @@ def merge_layers(layers, respect_visibility=True, skip_layer=lambda layer: False
         x, y = layer.bbox.x1 - bbox.x1, layer.bbox.y1 - bbox.y1
         w, h = layer_image.size
 
-        if x < 0 or y < 0:  # image doesn't fit the bbox
-            x_overflow = - min(x, 0)
-            y_overflow = - min(y, 0)
-            logger.debug("cropping.. (%s, %s)", x_overflow, y_overflow)
-            layer_image = layer_image.crop((x_overflow, y_overflow, w, h))
-            x += x_overflow
-            y += y_overflow
-
-        if w+x > bbox.width or h+y > bbox.height:
-            # FIXME
-            logger.debug("cropping..")
+        # crop the parts of the layer which don't fit the bbox
+        left, top = max(-x, 0), max(-y, 0)
+        right, bottom = min(w, bbox.width - x), min(h, bbox.height - y)
+        if right <= left or bottom <= top:
+            continue
+        if (left, top, right, bottom) != (0, 0, w, h):
+            logger.debug("cropping.. (%s, %s, %s, %s)", left, top, right, bottom)
+            layer_image = layer_image.crop((left, top, right, bottom))
+            x += left
+            y += top
 
         if layer.blend_mode == BlendMode.NORMAL:
             if layer_image.mode == 'RGBA':
-                tmp = Image.new("RGBA", result.size, color=(255, 255, 255, 0))
-                tmp.paste(layer_image, (x, y))
-                result = Image.alpha_composite(result, tmp)
+                if layer_image.getbbox() is None:
+                    continue  # fully transparent
+                # composite only the area covered by the layer
+                w, h = layer_image.size
+                region = result.crop((x, y, x + w, y + h))
+                region = Image.alpha_composite(region, layer_image)
+                result.paste(region, (x, y))
             elif layer_image.mode == 'RGB':
                 result.paste(layer_image, (x,y))
             else:
@@ -4,7 +4,8 @@ import pytest
 
 from .utils import load_psd, decode_psd, with_psb
 
-from psd_tools import PSDImage, BBox
+from psd_tools import PSDImage, Layer, BBox
+from psd_tools.user_api.layers import group_layers
 from psd_tools.decoder.image_resources import ResolutionInfo
 from psd_tools.constants import DisplayResolutionUnit, DimensionUnit, ImageResourceID
 
@@ -87,3 +88,20 @@ def test_bbox(filename, layer_index, bbox):
     psd = PSDImage(decode_psd(filename))
     layer = psd.layers[layer_index]
     assert layer.bbox == bbox
+
+
+def test_bbox_after_adding_nested_layer():
+    decoded = decode_psd('clipping-mask.psd')
+    background_index = group_layers(decoded)[1]['index']
+    psd = PSDImage(decoded)
+    psd.layers.pop()  # move the background into a nested group below
+
+    group2 = psd.layers[0]
+    group1 = group2.layers[2]
+    assert psd.bbox == BBox(50, -73, 288, 146)
+    assert group2.bbox == BBox(50, -73, 288, 146)
+
+    group1._add_layer(Layer(group1, background_index))
+    assert group1.bbox == BBox(0, -73, 360, 200)
+    assert group2.bbox == BBox(0, -73, 360, 200)
+    assert psd.bbox == BBox(0, -73, 360, 200)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+from psd_tools import PSDImage
 from psd_tools.user_api.layers import group_layers
 from .utils import decode_psd
 
@@ -53,6 +54,38 @@ def test_group_visibility():
     assert group1['layers'][0]['visible'] == True
 
 
+def test_group_visibility_global():
+    psd = PSDImage(decode_psd('hidden-groups.psd'))
+
+    group2, group1, bg = psd.layers
+    assert group2.visible_global
+    assert not group1.visible_global
+    assert bg.visible_global
+
+    assert group2.layers[0].visible_global
+    assert not group1.layers[0].visible_global
+
+
+def test_nested_group_visibility_global():
+    decoded = decode_psd('clipping-mask.psd')
+
+    # no fixture has nested groups under a hidden one; hide the outer group
+    records = decoded.layer_and_mask_data.layers.layer_records
+    index = group_layers(decoded)[0]['index']
+    records[index] = records[index]._replace(
+        flags=records[index].flags._replace(visible=False))
+
+    psd = PSDImage(decoded)
+    group2 = psd.layers[0]
+    group1 = group2.layers[2]
+    shape4 = group1.layers[0]
+    assert not group2.visible
+    assert group1.visible and shape4.visible
+
+    assert not group1.visible_global
+    assert not shape4.visible_global
+
+
 def test_layer_visibility():
     visible = dict(
         (layer['name'], layer['visible'])
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+import errno
+import io
 import re
 import pytest
 
 from psd_tools import PSDImage
 from psd_tools.constants import TaggedBlock, SectionDivider, BlendMode
-from .utils import load_psd, decode_psd, with_psb
+from .utils import load_psd, decode_psd, with_psb, full_name
 from psd_tools.decoder.tagged_blocks import VectorMaskSetting
 
 
@@ -102,3 +104,26 @@ def test_patterns():
     tagged_blocks = dict(psd.layer_and_mask_data.tagged_blocks)
     assert b'Patt' in tagged_blocks
     assert len(tagged_blocks[b'Patt']) == 6
+
+
+def test_load_truncated_file(tmpdir):
+    with open(full_name('1layer.psd'), 'rb') as f:
+        data = f.read()[:1000]
+    path = tmpdir.join('truncated.psd')
+    path.write_binary(data)
+
+    with pytest.raises(AssertionError):
+        PSDImage.from_stream(io.BytesIO(data))
+    with pytest.raises(AssertionError):
+        PSDImage.load(str(path))
+
+
+def test_load_without_mmap(monkeypatch):
+    from psd_tools.user_api import psd_image
+
+    def failing_mmap(*args, **kwargs):
+        raise EnvironmentError(errno.ENODEV, "can't map this file")
+    monkeypatch.setattr(psd_image.mmap, 'mmap', failing_mmap)
+
+    psd = PSDImage.load(full_name('1layer.psd'))
+    assert len(psd.layers) == 1
@@ -3,6 +3,7 @@ from __future__ import absolute_import, unicode_literals
 import pytest
 
 from psd_tools import PSDImage, Layer, Group
+from psd_tools.user_api import pil_support
 
 from .utils import full_name, FuzzyInt, with_psb
 
@@ -193,3 +194,18 @@ def test_layer_merging_pixels_transparency(filename, point, color):
     psd = PSDImage.load(full_name(filename))
     merged_image = psd.as_PIL_merged()
     assert color == merged_image.getpixel(point)
+
+
+@pytest.mark.parametrize("opacity", [0, 1, 77, 128, 200, 254, 255])
+def test_apply_opacity(opacity):
+    from PIL import Image
+    data = bytes(bytearray((i * 7) % 256 for i in range(16 * 16 * 4)))
+    image = Image.frombytes('RGBA', (16, 16), data)
+
+    # reference: scale the alpha band alone and merge the bands back
+    r, g, b, a = image.split()
+    a = a.point(lambda i: i * opacity / 255.0)
+    expected = Image.merge('RGBA', [r, g, b, a])
+
+    result = pil_support.apply_opacity(image, opacity)
+    assert result.tobytes() == expected.tobytes()